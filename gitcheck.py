@@ -4,6 +4,7 @@ gitcheck - recursively check for unclean/unpushed git repositories.
 
 Usage:
     gitcheck [PATH] [-a] [--branches] [--ignore PATH]... [--maxdepth DEPTH]
+             [--jobs NUM] [--backend NAME]
     gitcheck -h
 
 Options:
@@ -11,29 +12,57 @@ Options:
     --branches                      Show untracked branches
     -i PATH --ignore PATH           Ignore this path
     -m LVL, --maxdepth LVL          Maximum recursion depth
+    -j NUM, --jobs NUM              Number of repositories to scan in parallel
+    --backend NAME                  Use 'git', 'gitstatusd' or 'pygit2' [default: git]
 
     -h, --help                      Show this help
 """
 
 import os
+import shutil
 import subprocess
-import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from fnmatch import fnmatch
+from functools import lru_cache, partial
 
-from docopt import docopt
+from docopt import docopt, DocoptExit
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+# Errors that make scanning a single repository fail
+SCAN_ERRORS = (subprocess.CalledProcessError, OSError, RuntimeError)
+if pygit2 is not None:
+    SCAN_ERRORS += (pygit2.GitError,)
 
 
 #----------------------------------------
 # Constants
 #----------------------------------------
 
+# Absolute path of the git executable (lets subprocess use posix_spawn)
+GIT = shutil.which('git') or 'git'
+
 # Check status of index/workdir
-GIT_STATUS = ['git', 'status', '--porcelain', '--branch']
-GIT_STASH = ['git', 'stash', 'list']
+GIT_STATUS = [GIT, '--no-optional-locks', 'status', '--porcelain=v2', '--branch',
+              '--untracked-files=normal', '--no-ahead-behind', '--no-renames']
+
+# Get sync status for each branch, and whether there are stashed entries
+SYNC_STATUS = [GIT, 'for-each-ref', 'refs/heads', 'refs/stash',
+               '--format', '%(refname)...%(upstream:short) %(push:track)']
+
+# Values accepted for --backend
+BACKENDS = ('git', 'gitstatusd', 'pygit2')
 
-# Get sync status for each branch
-SYNC_STATUS = ['git', 'for-each-ref', 'refs/heads',
-               '--format', '%(refname:short)...%(upstream:short) %(push:track)']
-SYNC_PART = re.compile(r'\[([^\[\]]*)\]$')
+# Directories that are never searched for repositories
+SKIP_DIRS = {'node_modules', '__pycache__'}
+
+# Lists additional name patterns to skip, one per line
+IGNORE_FILE = '.gitcheckignore'
 
 # Related commands:
 # - List remotes for all branches:
@@ -42,13 +71,99 @@ SYNC_PART = re.compile(r'\[([^\[\]]*)\]$')
 #       git rev-parse --symbolic-full-name --abbrev-ref master@{u}
 
 
+@lru_cache(maxsize=None)
 def realpath(p):
     return os.path.normpath(os.path.realpath(p))
 
 
+def git_popen(cmd, folder, **kwargs):
+    """Start a git command in the given repository with stdout piped."""
+    # Passing the folder via -C instead of cwd, and not closing fds (our own
+    # fds are non-inheritable anyway), allows subprocess to use posix_spawn
+    # rather than fork+exec:
+    return subprocess.Popen(
+        cmd[:1] + ['-C', folder] + cmd[1:],
+        stdout=subprocess.PIPE, close_fds=False, **kwargs)
+
+
+def git_outputs(commands, folder):
+    """Run several git commands concurrently in the given repository and
+    return their outputs, raising CalledProcessError if any of them fails."""
+    procs = [git_popen(cmd, folder) for cmd in commands]
+    outputs = [proc.communicate()[0] for proc in procs]
+    for proc, output in zip(procs, outputs):
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, output)
+    return outputs
+
+
+class GitStatusDaemon:
+
+    """Client for gitstatusd (https://github.com/romkatv/gitstatus), which
+    answers status queries for many repositories from a single long-running
+    process instead of spawning git for each of them."""
+
+    def __init__(self, executable='gitstatusd', threads=None):
+        threads = threads or os.cpu_count() or 1
+        self.proc = subprocess.Popen(
+            [executable, '-t', str(threads)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+        self.reader = threading.Thread(target=self._read_responses, daemon=True)
+        self.reader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.reader.join()
+
+    def submit(self, folder):
+        """Request the status of a repository. Returns a Future for the list
+        of response fields."""
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('gitstatusd has terminated')
+            request_id = str(self.next_id)
+            self.next_id += 1
+            self.pending[request_id] = future
+            self.proc.stdin.write(
+                request_id.encode('ascii') + b'\x1f' + os.fsencode(folder) + b'\x1e')
+            self.proc.stdin.flush()
+        return future
+
+    def _read_responses(self):
+        buf = b''
+        while True:
+            chunk = self.proc.stdout.read1(65536)
+            if not chunk:
+                break
+            *responses, buf = (buf + chunk).split(b'\x1e')
+            for response in responses:
+                fields = response.decode('utf-8').split('\x1f')
+                with self.lock:
+                    future = self.pending.pop(fields[0])
+                future.set_result(fields)
+        with self.lock:
+            self.closed = True
+            for future in self.pending.values():
+                future.set_exception(RuntimeError('gitstatusd has terminated'))
+            self.pending.clear()
+
+
 class GitSyncStatus:
 
     gone = False
+    different = False
     ahead = 0
     behind = 0
 
@@ -56,31 +171,32 @@ class GitSyncStatus:
         self.branch = branch
         self.remote = remote
         self.is_tracked = bool(remote)
-        sync_status = SYNC_PART.match(divergence)
-        if sync_status is None:
+        if not (divergence.startswith('[') and divergence.endswith(']')):
             return
-        for part in sync_status.group(1).split(','):
-            if part.strip() == 'gone':
+        for part in divergence[1:-1].split(', '):
+            if part == 'gone':
                 self.gone = True
-                continue
-            key, val = part.split()
-            setattr(self, key, int(val))
+            elif part == 'different':
+                self.different = True
+            else:
+                key, val = part.split(' ')
+                setattr(self, key, int(val))
 
     @classmethod
     def parse(cls, status_line):
-        branch = status_line
-        remote = divergence = ''
-        if '...' in branch:
-            branch, remote = branch.split('...', 1)
-            try:
-                remote, divergence = remote.split(maxsplit=1)
-            except ValueError:
-                pass
-        return cls(branch.strip(), remote.strip(), divergence.strip())
+        # <branch>[...<remote>[ <divergence>]]
+        i = status_line.find('...')
+        if i < 0:
+            return cls(status_line.strip(), '', '')
+        j = status_line.find(' ', i)
+        if j < 0:
+            return cls(status_line[:i], status_line[i+3:], '')
+        return cls(status_line[:i], status_line[i+3:j], status_line[j+1:].strip())
 
     @property
     def synced(self):
-        return self.ahead == 0 and self.behind == 0 and not self.gone
+        return (self.ahead == 0 and self.behind == 0 and
+                not self.gone and not self.different)
 
     def info(self):
         if self.is_tracked:
@@ -93,51 +209,124 @@ class GitSyncStatus:
             '', code, self.branch)
 
 
+# XY status characters that can appear in porcelain entry lines
+FLAG_CHARS = 'MADRCUT'
+
+# Bit of each status character in a GitFlags bitmask, indexed by byte value
+CHARMASK = bytearray(256)
+for i, c in enumerate(FLAG_CHARS.encode('ascii')):
+    CHARMASK[c] = 1 << i
+del i, c
+
+
+def flag_property(char):
+    bit = 1 << FLAG_CHARS.index(char)
+    return property(lambda self: bool(self._bits & bit))
+
+
 class GitFlags:
 
+    """Set of XY status characters, stored as a bitmask over FLAG_CHARS."""
+
+    __slots__ = ('_bits',)
+
     def __init__(self, flags):
-        flags.discard(' ')
-        self.flags    = flags
-        self.clean    = not bool(flags)
-        self.modified = 'M' in flags
-        self.added    = 'A' in flags
-        self.deleted  = 'D' in flags
-        self.renamed  = 'R' in flags
-        self.copied   = 'C' in flags
-        self.unmerged = 'U' in flags
-        self.typechange = 'T' in flags
+        self._bits = sum(1 << i for i, c in enumerate(FLAG_CHARS) if c in flags)
+
+    @classmethod
+    def from_bits(cls, bits):
+        self = cls.__new__(cls)
+        self._bits = bits
+        return self
+
+    @property
+    def flags(self):
+        return {c for i, c in enumerate(FLAG_CHARS) if self._bits & (1 << i)}
+
+    @property
+    def clean(self):
+        return self._bits == 0
+
+    modified   = flag_property('M')
+    added      = flag_property('A')
+    deleted    = flag_property('D')
+    renamed    = flag_property('R')
+    copied     = flag_property('C')
+    unmerged   = flag_property('U')
+    typechange = flag_property('T')
 
 
 class GitStatus:
 
     sync_status = None
     untracked = False
+    has_stash = False
 
     def __init__(self, folder):
-        status = subprocess.check_output(GIT_STATUS, cwd=folder)
-        index_flags = set()
-        workdir_flags = set()
-        for l in status.decode('utf-8').splitlines():
-            if l.startswith('## '):
-                self.head_sync = GitSyncStatus.parse(l[3:])
-            elif l.startswith('?? '):
+        self.folder = folder
+        # status is parsed while it is being produced, for-each-ref runs
+        # concurrently and is collected afterwards:
+        with git_popen(GIT_STATUS, folder) as proc, \
+                git_popen(SYNC_STATUS, folder) as sync_proc:
+            stopped = self._parse_status(proc.stdout)
+            if stopped:
+                proc.terminate()
+            sync_output = sync_proc.communicate()[0]
+        if proc.returncode and not stopped:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        if sync_proc.returncode:
+            raise subprocess.CalledProcessError(
+                sync_proc.returncode, sync_proc.args, sync_output)
+        self._parse_refs(sync_output)
+
+    def _parse_refs(self, sync_output):
+        self.branch_sync = []
+        for line in sync_output.decode('utf-8').splitlines():
+            if line.startswith('refs/stash...'):
+                self.has_stash = True
+            else:
+                self.branch_sync.append(
+                    GitSyncStatus.parse(line[len('refs/heads/'):]))
+
+    def _parse_status(self, lines):
+        """Parse porcelain v2 status lines. Returns True if the remaining lines
+        were skipped because they could not change the result."""
+        branch = upstream = ''
+        ab = None
+        index_bits = 0
+        workdir_bits = 0
+        stopped = False
+        for l in lines:
+            if l.startswith(b'# '):
+                key, _, value = l[2:].rstrip(b'\n').decode('utf-8').partition(' ')
+                if key == 'branch.head':
+                    branch = 'HEAD (no branch)' if value == '(detached)' else value
+                elif key == 'branch.upstream':
+                    upstream = value
+                elif key == 'branch.ab':
+                    ab = value.split()
+            elif l.startswith(b'? '):
+                # untracked files are listed after all tracked entries:
                 self.untracked = True
+                stopped = True
+                break
             else:
-                i, w = l[:2]
-                index_flags.add(i)
-                workdir_flags.add(w)
-
-        self.workdir_status = GitFlags(workdir_flags)
-        self.index_status = GitFlags(index_flags)
-
-        stash_list = subprocess.check_output(GIT_STASH, cwd=folder)
-        self.num_stash_entries = len(stash_list.splitlines())
-
-        sync_output = subprocess.check_output(SYNC_STATUS, cwd=folder)
-        self.branch_sync = [
-            GitSyncStatus.parse(line)
-            for line in sync_output.decode('utf-8').splitlines()
-        ]
+                # '1 XY ...', '2 XY ...' or 'u XY ...'
+                index_bits |= CHARMASK[l[2]]
+                workdir_bits |= CHARMASK[l[3]]
+
+        self.head_sync = GitSyncStatus(branch, upstream, '')
+        if upstream and ab is None:
+            self.head_sync.gone = True
+        elif ab == ['+?', '-?']:
+            self.head_sync.different = True
+        elif ab:
+            self.head_sync.ahead = int(ab[0])
+            self.head_sync.behind = -int(ab[1])
+
+        self.workdir_status = GitFlags.from_bits(workdir_bits)
+        self.index_status = GitFlags.from_bits(index_bits)
+        return stopped
 
     @property
     def clean(self):
@@ -168,7 +357,7 @@ class GitStatus:
             ' ' if self.synced else 'L',
             ' ' if self.head_sync.is_tracked else 'H',
             ' ' if self.num_untracked_branches == 0 else 'B',
-            ' ' if self.num_stash_entries == 0 else 'S',
+            'S' if self.has_stash else ' ',
         ])
 
     @classmethod
@@ -184,53 +373,241 @@ class GitStatus:
         ])
 
 
-def collect_git_repositories(folder, ignore, maxdepth):
-    normpath = realpath(folder)
-    if normpath in ignore:
-        return
-    ignore.add(normpath)
-
-    subdirs = [fname for fname in os.listdir(folder)
-               if os.path.isdir(os.path.join(folder, fname))]
-    if '.git' in subdirs:
-        yield folder
-        return
-    if maxdepth == 0:
-        return
-    for subdir in subdirs:
-        if subdir.startswith('.'):
-            continue
-        subfolder = os.path.join(folder, subdir)
-        yield from collect_git_repositories(subfolder, ignore, maxdepth-1)
+class GitstatusdStatus(GitStatus):
+
+    """GitStatus with the work-dir, index, untracked and stash information
+    obtained from a GitStatusDaemon instead of by spawning git status."""
+
+    def __init__(self, folder, daemon):
+        self.folder = folder
+        response = daemon.submit(folder)
+        sync_output, = git_outputs([SYNC_STATUS], folder)
+        fields = response.result()
+        # libgit2 refuses some repositories that git can handle, e.g. ones
+        # using unsupported extensions; scan these with plain git instead:
+        if fields[1] != '1':
+            super().__init__(folder)
+            return
+        self._parse_response(fields)
+        self._parse_refs(sync_output)
+
+    def _parse_response(self, fields):
+        # See 'Response' in gitstatus/docs/gitstatusd.md for the field layout:
+        branch, upstream, remote = fields[4:7]
+        staged, unstaged, conflicted, untracked, ahead, behind, stashes = \
+            map(int, fields[10:17])
+
+        self.head_sync = GitSyncStatus(
+            branch or 'HEAD (no branch)',
+            remote + '/' + upstream if upstream else '', '')
+        self.head_sync.ahead = ahead
+        self.head_sync.behind = behind
+
+        index_flags = {'M'} if staged else set()
+        workdir_flags = {'M'} if unstaged else set()
+        if conflicted:
+            index_flags.add('U')
+            workdir_flags.add('U')
+        self.workdir_status = GitFlags(workdir_flags)
+        self.index_status = GitFlags(index_flags)
+        self.untracked = untracked > 0
+        self.has_stash = stashes > 0
+
 
+class Pygit2Status(GitStatus):
 
-def show_repos(folder=None, ignore=(), show_branch_details=False, maxdepth=-1, show_clean=False):
+    """GitStatus obtained in-process through libgit2 instead of by spawning
+    git. Sync status is reported relative to the upstream branch."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        repo = pygit2.Repository(folder)
+
+        index_flags = set()
+        workdir_flags = set()
+        for flags in repo.status(untracked_files='normal', ignored=False).values():
+            if flags & pygit2.GIT_STATUS_WT_NEW:
+                self.untracked = True
+            if flags & pygit2.GIT_STATUS_CONFLICTED:
+                index_flags.add('U')
+                workdir_flags.add('U')
+            for flag, char in [
+                    (pygit2.GIT_STATUS_INDEX_MODIFIED, 'M'),
+                    (pygit2.GIT_STATUS_INDEX_NEW, 'A'),
+                    (pygit2.GIT_STATUS_INDEX_DELETED, 'D'),
+                    (pygit2.GIT_STATUS_INDEX_RENAMED, 'R'),
+                    (pygit2.GIT_STATUS_INDEX_TYPECHANGE, 'T')]:
+                if flags & flag:
+                    index_flags.add(char)
+            for flag, char in [
+                    (pygit2.GIT_STATUS_WT_MODIFIED, 'M'),
+                    (pygit2.GIT_STATUS_WT_DELETED, 'D'),
+                    (pygit2.GIT_STATUS_WT_RENAMED, 'R'),
+                    (pygit2.GIT_STATUS_WT_TYPECHANGE, 'T')]:
+                if flags & flag:
+                    workdir_flags.add(char)
+
+        self.workdir_status = GitFlags(workdir_flags)
+        self.index_status = GitFlags(index_flags)
+        self.has_stash = bool(repo.listall_stashes())
+
+        self.branch_sync = [
+            self._branch_sync(repo, name)
+            for name in sorted(repo.branches.local)
+        ]
+
+        if repo.head_is_detached:
+            self.head_sync = GitSyncStatus('HEAD (no branch)', '', '')
+        else:
+            head = repo.references['HEAD'].target[len('refs/heads/'):]
+            self.head_sync = next(
+                (stat for stat in self.branch_sync if stat.branch == head),
+                GitSyncStatus(head, '', ''))
+
+    @staticmethod
+    def _branch_sync(repo, name):
+        branch = repo.branches.local[name]
+        upstream = branch.upstream
+        if upstream is None:
+            stat = GitSyncStatus(name, '', '')
+            # upstream is configured, but the remote branch does not exist:
+            stat.gone = 'branch.{}.merge'.format(name) in repo.config
+            stat.is_tracked = stat.gone
+            return stat
+        stat = GitSyncStatus(name, upstream.shorthand, '')
+        stat.ahead, stat.behind = repo.ahead_behind(branch.target, upstream.target)
+        return stat
+
+
+def read_ignore_file(folder):
+    """Return the patterns listed in the IGNORE_FILE within folder."""
+    try:
+        with open(os.path.join(folder, IGNORE_FILE)) as f:
+            lines = [line.strip() for line in f]
+    except FileNotFoundError:
+        return []
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def is_git_marker(entry):
+    """Check whether a directory entry named .git marks a repository. A .git
+    file (worktrees, submodules) only counts if its gitdir still exists."""
+    if entry.is_dir():
+        return True
+    try:
+        with open(entry.path) as f:
+            line = f.readline().rstrip('\n')
+    except OSError:
+        return False
+    if not line.startswith('gitdir: '):
+        return False
+    gitdir = os.path.join(os.path.dirname(entry.path), line[len('gitdir: '):])
+    return os.path.isdir(gitdir)
+
+
+def collect_git_repositories(folder, ignore, maxdepth, skip=()):
+    stack = [(folder, realpath(folder), maxdepth)]
+    while stack:
+        folder, normpath, maxdepth = stack.pop()
+        if normpath in ignore:
+            continue
+        ignore.add(normpath)
+
+        with os.scandir(folder) as entries:
+            entries = list(entries)
+        if any(entry.name == '.git' and is_git_marker(entry) for entry in entries):
+            yield folder
+            continue
+        if maxdepth == 0:
+            continue
+        subdirs = [
+            entry for entry in entries
+            if not entry.name.startswith('.')
+            and entry.name not in SKIP_DIRS
+            and not any(fnmatch(entry.name, pattern) for pattern in skip)
+            and entry.is_dir()
+        ]
+        # push in reverse to visit subdirectories in listing order. Only
+        # symlinks need to be resolved, other paths stay canonical:
+        stack.extend((
+            subdir.path,
+            realpath(subdir.path) if subdir.is_symlink() else
+            os.path.join(normpath, subdir.name),
+            maxdepth-1,
+        ) for subdir in reversed(subdirs))
+
+
+def try_scan(scan, folder):
+    """Return ``scan(folder)``, or the exception if scanning failed."""
+    try:
+        return scan(folder)
+    except SCAN_ERRORS as e:
+        return e
+
+
+def scan_repositories(folders, jobs=None, scan=GitStatus):
+    """Yield ``(folder, status)`` for each folder, in order, scanning up to
+    ``jobs`` repositories concurrently. If scanning a repository fails, its
+    status is the exception."""
+    folders = list(folders)
+    if jobs is None:
+        jobs = (os.cpu_count() or 1) * 4
+    jobs = max(1, min(jobs, len(folders)))
+    # schedule repositories on the same file system together:
+    by_device = sorted(folders, key=lambda folder: os.stat(folder).st_dev)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {folder: executor.submit(try_scan, scan, folder)
+                   for folder in by_device}
+        for folder in folders:
+            yield folder, futures[folder].result()
+
+
+def show_repos(folder=None, ignore=(), show_branch_details=False, maxdepth=-1, show_clean=False,
+               jobs=None, backend='git'):
     if folder is None:
         folder = '.'
     folder = os.path.realpath(folder)
     ignore = set(map(realpath, ignore))
 
-    for folder in collect_git_repositories(folder, ignore, maxdepth):
-        status = GitStatus(folder)
-        if status.clean and not show_clean:
-            continue
-        print(status.code(), folder)
+    with ExitStack() as stack:
+        # fall back to plain git if the backend is not installed:
+        if backend == 'gitstatusd' and shutil.which('gitstatusd'):
+            daemon = stack.enter_context(GitStatusDaemon())
+            scan = partial(GitstatusdStatus, daemon=daemon)
+        elif backend == 'pygit2' and pygit2 is not None:
+            scan = Pygit2Status
+        else:
+            scan = GitStatus
+
+        skip = read_ignore_file(folder)
+        folders = collect_git_repositories(folder, ignore, maxdepth, skip)
+        for folder, status in scan_repositories(folders, jobs, scan):
+            if isinstance(status, Exception):
+                print('{:7} {} ({})'.format('ERROR', folder, status))
+                continue
+            if status.clean and not show_clean:
+                continue
+            print(status.code(), folder)
 
-        if show_branch_details:
-            for stat in status.branch_sync:
-                if not stat.synced or not stat.is_tracked:
-                    print(stat.info())
+            if show_branch_details:
+                for stat in status.branch_sync:
+                    if not stat.synced or not stat.is_tracked:
+                        print(stat.info())
 
 
 def main(args=None):
     opts = docopt(__doc__, args)
+    if opts['--backend'] not in BACKENDS:
+        raise DocoptExit('Unknown backend: {}'.format(opts['--backend']))
     print(GitStatus.legend())
     show_repos(
         opts['PATH'],
         opts['--ignore'],
         show_branch_details=opts['--branches'],
         maxdepth=int(opts['--maxdepth'] or -1),
-        show_clean=opts['--all'])
+        show_clean=opts['--all'],
+        jobs=int(opts['--jobs']) if opts['--jobs'] else None,
+        backend=opts['--backend'])
 
 
 if __name__ == '__main__':